@@ -1,37 +1,328 @@
 import argparse
+import bisect
+import hashlib
+import itertools
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Tuple
 
+from PIL import Image
 from clams import ClamsApp, Restifier
 from clams.appmetadata import AppMetadata
 from mmif import Mmif, View, Document, AnnotationTypes, DocumentTypes
-from mmif.utils import video_document_helper as vdh, text_document_helper
+from mmif.utils import video_document_helper as vdh
 from transformers import LlavaNextForConditionalGeneration, BitsAndBytesConfig, LlavaNextProcessor
+from transformers.utils import is_flash_attn_2_available
 import torch
 
+from metadata import DEFAULT_BATCH_SIZE
+
+
+MODEL_NAME = "llava-hf/llava-v1.6-mistral-7b-hf"
+TOKEN_TYPE = "http://vocab.lappsgrid.org/Token"
+SINGLE_TILE_GRID = [[336, 336]]
+# (width, height) of the dummy frame for the warm-up, in the 16:9 aspect ratio of most input videos
+WARMUP_FRAME_SIZE = (640, 360)
+# prompts are padded up to a multiple of this many tokens, so that the static KV cache of the
+# compiled decoder comes in a small set of lengths instead of recompiling for every batch
+PAD_TO_MULTIPLE_OF = 64
+# number of frames whose projected vision features are kept on the device for reuse
+IMAGE_FEATURE_CACHE_SIZE = 32
+
+
+class TextIndex(NamedTuple):
+    """
+    Tokens aligned to time frames, as ``(start_frame, end_frame, word)`` sorted by start frame.
+    """
+    starts: List[int]
+    tokens: List[Tuple[int, int, str]]
+    max_duration: int
+
 
 class LlavaCaptioner(ClamsApp):
 
-    def __init__(self):
+    def __init__(self, warmup_batch_size: int = DEFAULT_BATCH_SIZE, use_vllm: bool = False):
         super().__init__()
+        self.processor = LlavaNextProcessor.from_pretrained(MODEL_NAME)
+        # batched generation with a decoder-only model needs the padding on the left
+        self.processor.tokenizer.padding_side = "left"
+        # a single 336px tile is enough detail for captioning video frames, so the anyres layout is
+        # limited to that one grid, instead of splitting each frame into up to four tiles
+        self.processor.image_processor.image_grid_pinpoints = SINGLE_TILE_GRID
+        self._image_feature_cache = OrderedDict()
+        self._image_keys = []
+        self._copy_stream = None
+        self._use_vllm = use_vllm
+        self._warmup_batch_size = warmup_batch_size
+        # the model and the generation thread are created lazily by ``_setup``
+        self.model = None
+        self.llm = None
+        self._generation_executor = None
+        self._setup_lock = threading.Lock()
+
+    def _setup(self):
+        """
+        Loads (and warms up) the model and starts the generation thread, on the first request.
+        This is deferred from ``__init__`` because gunicorn forks its worker from the master process
+        after the app is constructed, and neither CUDA state nor threads survive the fork.
+        """
+        with self._setup_lock:
+            if self._generation_executor is not None:
+                return
+            # a single generation thread owns the model, so that batches (also from concurrent requests)
+            # run on the GPU one at a time while the calling thread keeps preparing inputs
+            self._generation_executor = ThreadPoolExecutor(max_workers=1)
+            try:
+                if self._use_vllm:
+                    # vLLM is an optional dependency, only needed when serving with it
+                    from vllm import LLM, SamplingParams
+                    # continuous batching and paged KV cache, with the shared prompt prefix reused across requests
+                    self.llm = LLM(model=MODEL_NAME, max_num_seqs=32, enable_prefix_caching=True,
+                                   limit_mm_per_prompt={"image": 1})
+                    self.sampling_params = SamplingParams(temperature=0, max_tokens=200, repetition_penalty=1.5)
+                else:
+                    self._load_model(self._warmup_batch_size)
+            except Exception:
+                # a failed load (out of memory, download error, ...) is retried on the next request,
+                # instead of leaving the worker looking set up but without a model
+                self._generation_executor.shutdown(wait=False)
+                self._generation_executor = None
+                self.llm = None
+                # a model that loaded but failed to warm up would otherwise hold its memory through the
+                # retry, also through the bound methods and features kept of it
+                self.model = None
+                self._get_image_features = None
+                self._vision_tower_forward = None
+                self._vision_graph = None
+                self._image_feature_cache.clear()
+                self._copy_stream = None
+                raise
+
+    def _load_model(self, warmup_batch_size: int):
+        """
+        Loads the 4-bit quantized model for generation with transformers.
+        """
         quantization_config = BitsAndBytesConfig(
             load_in_4bit=True,
             bnb_4bit_quant_type="nf4",
             bnb_4bit_compute_dtype=torch.float16,
+            # only the language model is quantized; the vision tower and projector are small, and
+            # dequantizing their weights on every forward costs more than it saves. The output head
+            # is skipped by default, but giving this list replaces the default, so it is listed too
+            llm_int8_skip_modules=["vision_tower", "multi_modal_projector", "lm_head"],
         )
         self.model = LlavaNextForConditionalGeneration.from_pretrained(
-            "llava-hf/llava-v1.6-mistral-7b-hf", 
+            MODEL_NAME, 
             quantization_config=quantization_config, 
+            torch_dtype=torch.float16,
+            # PyTorch's fused SDPA kernels when flash-attn is not installed, rather than eager attention
+            attn_implementation="flash_attention_2" if is_flash_attn_2_available() else "sdpa",
             device_map="auto"
         )
-        self.processor = LlavaNextProcessor.from_pretrained("llava-hf/llava-v1.6-mistral-7b-hf")
+        self.model.eval()
+        self.model.config.image_grid_pinpoints = SINGLE_TILE_GRID
+        # identical frames (slates, color bars, black frames, ...) skip the vision tower
+        self._get_image_features = self.model.get_image_features
+        self.model.get_image_features = self._cached_image_features
+        if torch.cuda.is_available():
+            # host to device copies of the next batch run on their own stream
+            self._copy_stream = torch.cuda.Stream()
+            # decoding is bound by per-token kernel launches; with a static KV cache on CUDA, ``generate``
+            # compiles the decoding steps itself (``generation_config.compile_config``, reduce-overhead
+            # mode by default) and replays them as CUDA graphs, while the prefill stays eager.
+            # FlashAttention-2 cannot attend over a static cache, but it already skips padded
+            # positions by running on unpadded, variable-length sequences
+            if self.model.config._attn_implementation != "flash_attention_2":
+                self.model.generation_config.cache_implementation = "static"
+            # the vision tower is a plain feed-forward pass over fixed-size tiles, so it is
+            # captured as a CUDA graph and replayed
+            self._vision_graph = None
+            self._vision_tower_forward = self.model.vision_tower.forward
+            self.model.vision_tower.forward = self._graphed_vision_tower
+            self._warmup(warmup_batch_size)
+
+    def _cached_image_features(self, pixel_values: torch.Tensor, image_sizes: torch.Tensor, *args, **kwargs):
+        """
+        Drop-in replacement for ``get_image_features`` of the model that memoizes the vision tower
+        and projector output of each image, keyed by a hash of its pixel values. The hashes are
+        computed on the host by ``_prepare_inputs`` and set by ``_process_batch`` for the batch being
+        generated, so that no device to host copy is needed here.
+        """
+        keys = self._image_keys
+        if len(pixel_values) != len(keys):
+            # beam search repeats each image of the batch once per beam
+            keys = [key for key in keys for _ in range(len(pixel_values) // len(keys))]
+        misses = [i for i, key in enumerate(keys) if key not in self._image_feature_cache]
+        if misses:
+            features = self._get_image_features(pixel_values[misses], image_sizes[misses], *args, **kwargs)
+            for i, feature in zip(misses, features):
+                # the features are split views of one tensor for the whole batch, which a single
+                # cached view would otherwise keep allocated
+                self._image_feature_cache[keys[i]] = feature.clone()
+        image_features = []
+        for key in keys:
+            self._image_feature_cache.move_to_end(key)
+            image_features.append(self._image_feature_cache[key])
+        while len(self._image_feature_cache) > IMAGE_FEATURE_CACHE_SIZE:
+            self._image_feature_cache.popitem(last=False)
+        return image_features
+
+    def _graphed_vision_tower(self, pixel_values: torch.Tensor, *args, **kwargs):
+        """
+        Drop-in replacement for the vision tower forward that replays a CUDA graph. A single graph is
+        captured on the first call (the warm-up batch); smaller batches of tiles are padded up to its
+        shape and the output is cut back to their size, while larger batches or other arguments run
+        eagerly. Note that the returned output lives in static buffers that are overwritten by the
+        next call.
+        """
+        key = (tuple(pixel_values.shape[1:]), pixel_values.dtype, args, tuple(sorted(kwargs.items())))
+        if self._vision_graph is None:
+            static_input = pixel_values.clone()
+            # warm up on a side stream before capturing, as required by CUDA graphs
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                for _ in range(2):
+                    self._vision_tower_forward(static_input, *args, **kwargs)
+            torch.cuda.current_stream().wait_stream(side_stream)
+            graph = torch.cuda.CUDAGraph()
+            # other threads keep preparing (pinning and copying) inputs while the graph is captured
+            with torch.cuda.graph(graph, capture_error_mode="thread_local"):
+                static_output = self._vision_tower_forward(static_input, *args, **kwargs)
+            self._vision_graph = (key, graph, static_input, static_output)
+        graph_key, graph, static_input, static_output = self._vision_graph
+        num_tiles = len(pixel_values)
+        # the graph keeps the hidden states of every layer for all of its tiles, so only the one is kept
+        if key != graph_key or num_tiles > len(static_input):
+            return self._vision_tower_forward(pixel_values, *args, **kwargs)
+        # the padding tiles keep whatever the previous call left in the input buffer
+        static_input[:num_tiles].copy_(pixel_values, non_blocking=True)
+        graph.replay()
+        if num_tiles == len(static_input):
+            return static_output
+        return type(static_output)(**{
+            name: tuple(tensor[:num_tiles] for tensor in value) if isinstance(value, tuple) else value[:num_tiles]
+            for name, value in static_output.items()
+        })
+
+    def _warmup(self, batch_size: int):
+        """
+        Runs a dummy batch through the model to pay the compilation cost before serving requests.
+        """
+        # the number of image tokens depends on the aspect ratio of the frame
+        image = Image.new("RGB", WARMUP_FRAME_SIZE)
+        prompt = self.get_prompt(None, {}, "Describe what is shown in this video frame.")
+        inputs, image_keys, copy_event = self._prepare_inputs([prompt] * batch_size, [image] * batch_size)
+        # compiled CUDA graphs are recorded per thread, so warm up on the generation thread
+        self._generation_executor.submit(self._process_batch, inputs, image_keys, copy_event, 1).result()
+
+    def _prepare_inputs(self, prompts: List[str], images: List[Image.Image]):
+        """
+        Turns a batch of prompts and images into model inputs. With transformers on CUDA, the processed
+        tensors are copied to the device from pinned memory on a separate stream, so that the copy
+        overlaps with the generation of the previous batch. Returns the inputs, the keys of the images
+        for the vision feature cache, and the CUDA event that marks the end of the copy (``None`` when
+        there is nothing to wait for).
+        """
+        if self.llm is not None:
+            return [{"prompt": prompt, "multi_modal_data": {"image": image}}
+                    for prompt, image in zip(prompts, images)], None, None
+        inputs = self.processor(images=images, text=prompts, padding=True, pad_to_multiple_of=PAD_TO_MULTIPLE_OF,
+                                return_tensors="pt")
+        image_keys = [hashlib.sha1(image_pixels.numpy().tobytes()).hexdigest()
+                      for image_pixels in inputs["pixel_values"]]
+        if self._copy_stream is None:
+            return inputs.to(self.model.device), image_keys, None
+        with torch.cuda.stream(self._copy_stream):
+            inputs = {k: (v.pin_memory() if v.is_floating_point() else v).to(self.model.device, non_blocking=True)
+                      for k, v in inputs.items()}
+            copy_event = self._copy_stream.record_event()
+        return inputs, image_keys, copy_event
+
+    def _process_batch(self, inputs, image_keys, copy_event, num_beams: int) -> List[str]:
+        """
+        Generates captions for one batch of inputs from ``_prepare_inputs``, on the generation thread.
+        """
+        if copy_event is not None:
+            torch.cuda.current_stream().wait_event(copy_event)
+            # the tensors were allocated on the copy stream, but are used and freed on this one
+            for v in inputs.values():
+                v.record_stream(torch.cuda.current_stream())
+        # only read by ``_cached_image_features``, which runs on this same thread
+        self._image_keys = image_keys
+        # inference mode is thread-local, so it is entered here rather than around the submission
+        with torch.inference_mode():
+            return self._generate(inputs, num_beams)
+
+    @staticmethod
+    def _add_captions(new_view: View, generated_texts: List[str], annotations: List[dict]):
+        for generated_text, annotation in zip(generated_texts, annotations):
+            text_document = new_view.new_textdocument(generated_text.strip())
+            alignment = new_view.new_annotation(AnnotationTypes.Alignment)
+            alignment.add_property("source", annotation['source'])
+            alignment.add_property("target", text_document.long_id)
+
+    def _generate(self, inputs, num_beams: int = 1) -> List[str]:
+        if self.llm is not None:
+            # beam search is not available through vLLM sampling parameters, so decoding is always greedy
+            outputs = self.llm.generate(inputs, self.sampling_params, use_tqdm=False)
+            return [output.outputs[0].text for output in outputs]
+        outputs = self.model.generate(
+            **inputs,
+            do_sample=False,
+            num_beams=num_beams,
+            max_new_tokens=200,
+            min_length=1,
+            repetition_penalty=1.5,
+            use_cache=True,
+            pad_token_id=self.processor.tokenizer.eos_token_id,
+        )
+        # prompts are left-padded, so the generated tokens all start at the same position
+        return self.processor.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
 
     def _appmetadata(self) -> AppMetadata:
         pass
 
-    def get_context(self, mmif: Mmif, timeframe:AnnotationTypes.TimeFrame, max_characters: int = 200) -> str:
-        start_frame = timeframe.properties["start"]
-        end_frame = timeframe.properties["end"]
-        sliced_text = text_document_helper.slice_text(mmif, start_frame, end_frame, unit="frame")
+    def index_text(self, mmif: Mmif) -> TextIndex:
+        """
+        Collects the tokens aligned to time frames in the MMIF once, sorted by start frame, so that
+        ``get_context`` can look up the text under a time frame by binary search.
+        """
+        tokens = []
+        for view_id, annotations in mmif.get_alignments(AnnotationTypes.TimeFrame, TOKEN_TYPE).items():
+            for alignment in annotations:
+                # the aligned annotations of the view are returned along with the alignments
+                if not alignment.is_type(AnnotationTypes.Alignment):
+                    continue
+                ends = []
+                for prop in ("source", "target"):
+                    ann_id = alignment.get_property(prop)
+                    ends.append(mmif[ann_id if ":" in ann_id else f"{view_id}:{ann_id}"])
+                timeframe, token = ends if ends[0].is_type(AnnotationTypes.TimeFrame) else reversed(ends)
+                start, end = vdh.convert_timeframe(mmif, timeframe, "frame")
+                tokens.append((start, end, token.get_property("word")))
+        tokens.sort(key=lambda token: token[0])
+        max_duration = max((end - start for start, end, _ in tokens), default=0)
+        return TextIndex([token[0] for token in tokens], tokens, max_duration)
+
+    def get_context(self, mmif: Mmif, text_index: TextIndex,
+                    timeframe:AnnotationTypes.TimeFrame, max_characters: int = 200) -> str:
+        start_frame, end_frame = vdh.convert_timeframe(mmif, timeframe, "frame")
+        words = []
+        num_characters = 0
+        # tokens that overlap the time frame are included, so the search starts at the earliest start
+        # of a token that can still reach into it. A token that only touches an edge of the time frame
+        # does not overlap it, so that the word between back-to-back shots goes to only one of them
+        first = bisect.bisect_right(text_index.starts, start_frame - text_index.max_duration)
+        for token_start, token_end, word in itertools.islice(text_index.tokens, first, None):
+            if token_start >= end_frame or num_characters >= max_characters:
+                break
+            if token_end > start_frame:
+                words.append(word)
+                num_characters += len(word) + 1
+        sliced_text = " ".join(words)
         sliced_text = sliced_text[:max_characters]
         return sliced_text
     
@@ -42,11 +333,44 @@ class LlavaCaptioner(ClamsApp):
         prompt = f"[INST] <image>\n{prompt}\n[/INST]"
         return prompt
 
+    def _extract_frames(self, video_doc: Document, frame_numbers: List[int]) -> Dict[int, Image.Image]:
+        """
+        Extracts the given frames of the video as PIL images, keyed by frame number, in a single pass
+        through the video. Frames that cannot be read are left out.
+        """
+        # the frames are read here rather than with ``vdh.extract_frames_as_images``, which drops
+        # unreadable frames without telling which ones (and older mmif versions never get past them)
+        frame_images = {}
+        video = vdh.capture(video_doc)
+        try:
+            frame_number = 0
+            for target in sorted(set(frame_numbers)):
+                # the frames in between are only grabbed, without being converted to images
+                while frame_number < target and video.grab():
+                    frame_number += 1
+                if frame_number < target:
+                    break
+                ret, frame = video.read()
+                frame_number += 1
+                if ret:
+                    frame_images[target] = Image.fromarray(frame[:, :, ::-1])
+        finally:
+            video.release()
+        missing = sorted(set(frame_numbers) - frame_images.keys())
+        if missing:
+            self.logger.warning(f"Could not extract frames {missing} of {video_doc.id}, skipping them")
+        return frame_images
+
     def _annotate(self, mmif: Mmif, **parameters) -> Mmif:
+        self._setup()
         label_map = parameters.get('promptMap')
         default_prompt = parameters.get('defaultPrompt')
         frame_interval = parameters.get('frameInterval', 30)  # Default to every 30th frame if not specified
-        batch_size = parameters.get('batchSize', 8)  # Default batch size
+        batch_size = parameters.get('batchSize', DEFAULT_BATCH_SIZE)
+        num_beams = parameters.get('numBeams', 1)  # Default to greedy decoding
+        # the cache is only touched from the generation thread, so that concurrent requests cannot
+        # clear it while a batch is looking up its features
+        self._generation_executor.submit(self._image_feature_cache.clear)
 
         video_doc: Document = mmif.get_documents_by_type(DocumentTypes.VideoDocument)[0]
         input_views: View = mmif.get_views_for_document(video_doc.id)
@@ -57,79 +381,79 @@ class LlavaCaptioner(ClamsApp):
         new_view.new_contain(DocumentTypes.TextDocument)
         new_view.new_contain(AnnotationTypes.Alignment)
 
-        timeframes = input_view.get_annotations(AnnotationTypes.TimeFrame)
+        timeframes = list(input_view.get_annotations(AnnotationTypes.TimeFrame))
+        text_index = self.index_text(mmif)
         prompts = []
         images = []
         annotations = []
 
-        def process_batch(prompts, images, annotations):
-            inputs = self.processor(images=images, text=prompts, padding=True, return_tensors="pt").to(self.model.device)
-            outputs = self.model.generate(
-                **inputs,
-                do_sample=False,
-                num_beams=5,
-                max_new_tokens=200,
-                min_length=1,
-                repetition_penalty=1.5,
-                length_penalty=1.0,
-                temperature=1,
-            )
-            generated_texts = self.processor.batch_decode(outputs, skip_special_tokens=True)
-            for generated_text, annotation in zip(generated_texts, annotations):
-                text_document = new_view.new_textdocument(generated_text.strip())
-                alignment = new_view.new_annotation(AnnotationTypes.Alignment)
-                alignment.add_property("source", annotation['source'])
-                alignment.add_property("target", text_document.long_id)
-
         if timeframes:
-            for timeframe in list(timeframes):
-                print (timeframe)
-                context = self.get_context(mmif, timeframe)
-                label = timeframe.get_property('label')
-                prompt = self.get_prompt(label, label_map, default_prompt)
-                prompt = prompt.replace("[CONTEXT]", context)
-
-                print (prompt)
-                if not prompt:
+            # timeframes with skipped labels are dropped before any frame is decoded
+            prompt_templates = {}
+            for timeframe in timeframes:
+                prompt = self.get_prompt(timeframe.get_property('label'), label_map, default_prompt)
+                if prompt is not None:
+                    prompt_templates[timeframe.long_id] = prompt
+            captioned_timeframes = [timeframe for timeframe in timeframes if timeframe.long_id in prompt_templates]
+            # all mid frames are read in a single pass through the video, instead of a seek per timeframe
+            # todo: use the representative frames when the timeframe has them
+            #  (vdh.extract_representative_frame hangs)
+            mid_frames = {timeframe.long_id: vdh.get_mid_framenum(mmif, timeframe) for timeframe in captioned_timeframes}
+            frame_images = self._extract_frames(video_doc, sorted(set(mid_frames.values())))
+            for timeframe in captioned_timeframes:
+                mid_frame = mid_frames[timeframe.long_id]
+                if mid_frame not in frame_images:
                     continue
+                context = self.get_context(mmif, text_index, timeframe)
+                prompt = prompt_templates[timeframe.long_id].replace("[CONTEXT]", context)
+                self.logger.debug(prompt)
 
-                representatives = timeframe.get("representatives") if "representatives" in timeframe.properties else None
-                if representatives:
-                    # image = vdh.extract_representative_frame(mmif, timeframe) #todo why isnt this working? hangs
-                    image = vdh.extract_mid_frame(mmif, timeframe)
-                else:
-                    image = vdh.extract_mid_frame(mmif, timeframe)
                 prompts.append(prompt)
-                images.append(image)
+                images.append(frame_images[mid_frame])
                 annotations.append({'source': timeframe.long_id})
-
-                if len(prompts) == batch_size:
-                    process_batch(prompts, images, annotations)
-                    prompts, images, annotations = [], [], []
-
-            if prompts:
-                process_batch(prompts, images, annotations)
         else:
-            total_frames = vdh.get_frame_count(video_doc)
+            prompt = self.get_prompt(None, {}, default_prompt)
+            # without timeframes every frame gets the default prompt, so `-` leaves nothing to caption
+            if prompt is None:
+                return mmif
+            # capturing the video adds its frame count to the document properties
+            vdh.capture(video_doc).release()
+            total_frames = int(video_doc.get_property("frameCount"))
             frame_numbers = list(range(0, total_frames, frame_interval))
-            images = vdh.extract_frames_as_images(video_doc, frame_numbers)
-
-            for frame_number, image in zip(frame_numbers, images):
-                prompt = default_prompt
+            frame_images = self._extract_frames(video_doc, frame_numbers)
 
+            for frame_number in frame_numbers:
+                if frame_number not in frame_images:
+                    continue
                 prompts.append(prompt)
-                images.append(image)
+                images.append(frame_images[frame_number])
                 # Create new timepoint annotation
                 timepoint = new_view.new_annotation(AnnotationTypes.TimePoint)
                 timepoint.add_property("timePoint", frame_number)
                 annotations.append({'source': timepoint.long_id})
 
-                if len(prompts) == batch_size:
-                    process_batch(prompts, images, annotations)
-                    prompts, images, annotations = [], [], []
-
-            if prompts:
-                process_batch(prompts, images, annotations)
+        # batch prompts of similar token length together, so that little compute goes to padding,
+        # and keep identical prompts next to each other, so that vLLM can reuse their cached prefix
+        # (with transformers the only prefix shared ahead of the image tokens is `[INST] `, and
+        # every token after the image attends to it, so there is no KV cache worth reusing)
+        batch_items = sorted(zip(prompts, images, annotations),
+                             key=lambda item: (len(self.processor.tokenizer(item[0]).input_ids), item[0]))
+        if self.llm is not None:
+            # vLLM schedules the sequences itself (continuous batching), so all prompts go in one call
+            batch_size = max(len(batch_items), 1)
+        # the inputs of the next batch are prepared while the previous one is being generated, and
+        # annotations are only added from this thread, as the view is not thread-safe
+        pending = None
+        for i in range(0, len(batch_items), batch_size):
+            batch = batch_items[i:i + batch_size]
+            inputs, image_keys, copy_event = self._prepare_inputs([item[0] for item in batch],
+                                                                  [item[1] for item in batch])
+            if pending is not None:
+                self._add_captions(new_view, pending[0].result(), pending[1])
+            future = self._generation_executor.submit(self._process_batch, inputs, image_keys, copy_event, num_beams)
+            pending = (future, [item[2] for item in batch])
+        if pending is not None:
+            self._add_captions(new_view, pending[0].result(), pending[1])
 
         return mmif
 
@@ -139,17 +463,21 @@ if __name__ == "__main__":
     parser.add_argument("--port", action="store", default="5000", help="set port to listen")
     parser.add_argument("--production", action="store_true", help="run gunicorn server")
     parser.add_argument("--frameInterval", type=int, default=10, help="Interval of frames for captioning when no timeframes are present")
-    parser.add_argument("--batchSize", type=int, default=4, help="Batch size for processing prompt+image pairs")
+    parser.add_argument("--batchSize", type=int, default=DEFAULT_BATCH_SIZE, help="Batch size to warm up the model with; should match the batchSize parameter of requests")
+    parser.add_argument("--vllm", action="store_true", help="generate with vLLM instead of transformers (requires vllm)")
 
     parsed_args = parser.parse_args()
 
-    app = LlavaCaptioner()
+    app = LlavaCaptioner(warmup_batch_size=parsed_args.batchSize, use_vllm=parsed_args.vllm)
 
     http_app = Restifier(app, port=int(parsed_args.port))
 
     # for running the application in production mode
     if parsed_args.production:
-        http_app.serve_production()
+        # one worker process owns the model (and the GPU); forked workers would each load their own copy,
+        # while threads share it and their generation is serialized by the app's generation thread.
+        # The model is only loaded in the worker, on its first request (see ``LlavaCaptioner._setup``)
+        http_app.serve_production(workers=1, threads=4)
     # development mode
     else:
         app.logger.setLevel(logging.DEBUG)
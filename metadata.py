@@ -9,6 +9,9 @@ from mmif import DocumentTypes, AnnotationTypes
 from clams.app import ClamsApp
 from clams.appmetadata import AppMetadata
 
+# shared with app.py, which warms the model up with batches of this size
+DEFAULT_BATCH_SIZE = 8
+
 
 # DO NOT CHANGE the function name 
 def appmetadata() -> AppMetadata:
@@ -50,6 +53,15 @@ def appmetadata() -> AppMetadata:
                      'prompt. In order to skip timeframes with a particular label, pass `-` as the prompt value.'
                      'in order to skip all timeframes not specified in the promptMap, set the defaultPrompt'
                      'parameter to `-`'))
+    metadata.add_parameter(
+        name='batchSize', type='integer', default=DEFAULT_BATCH_SIZE,
+        description='number of prompt and frame pairs to caption together in one batch.'
+    )
+    metadata.add_parameter(
+        name='numBeams', type='integer', default=1,
+        description='number of beams to use for caption generation. The default of 1 means greedy decoding, '
+                    'which is considerably faster than beam search. Use 2 or more for beam search.'
+    )
     
     return metadata
 